@@ -17,20 +17,35 @@
 # You should have received a copy of the GNU General Public License
 # along with CovidTracer. If not, see<https://www.gnu.org/licenses/>.
 
-import os, datetime
+import os, concurrent.futures, datetime, io, ipaddress, re, time, uuid
 
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.http import parse_date
 
+import orjson
+import redis
 import wtforms
 
-DAILY_KEY_SIZE = 256 / 8 # Bytes.
+DAILY_KEY_SIZE = 256 // 8 # Bytes.
+DAILY_KEY_REGEX = re.compile(r'\A[0-9a-fA-F]{%d}\Z' % (DAILY_KEY_SIZE * 2))
 
 INCUBATION_PERIOD = 5
 SYMPTOMS_TO_VIRUS_NEGATIVE = 11
 
 INFECTION_PERIOD = INCUBATION_PERIOD + SYMPTOMS_TO_VIRUS_NEGATIVE
 
+# New keys are published this long after each release time, so that notifications that started
+# before it are committed by then. Longer than gunicorn's 30 seconds worker timeout.
+RELEASE_DELAY = datetime.timedelta(minutes=1)
+
+# `/cases.json?since=` values older than this return all the active keys, which bounds the number
+# of cached responses.
+SINCE_MAX_AGE = datetime.timedelta(days=2)
+
+RATE_LIMIT_MAX_REQUESTS = 5
+RATE_LIMIT_PERIOD = datetime.timedelta(hours=1)
+
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
 
@@ -39,48 +54,223 @@ db = SQLAlchemy(app)
 
 import models
 
+@app.before_request
+def _set_now():
+    """Reads the current time once, so that it is consistent during the whole request."""
+
+    g.now = datetime.datetime.utcnow()
+    g.today = g.now.date()
+
+# Rate limiting counters are kept in Redis when available, and computed from the `requests` table
+# otherwise.
+#
+# In Redis, every address has a sliding window over a sorted set of its request timestamps. The
+# script atomically drops the expired requests, and adds the new one if there is room left, so that
+# concurrent requests can not all pass the check.
+_RESERVE_REQUEST_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+if app.config.get('REDIS_URL'):
+    redis_client = redis.Redis.from_url(app.config['REDIS_URL'])
+    _reserve_request_script = redis_client.register_script(_RESERVE_REQUEST_SCRIPT)
+else:
+    redis_client = None
+
+def _rate_limit_key(remote_addr):
+    return 'rate-limit:{}'.format(remote_addr)
+
+def reserve_request(remote_addr):
+    """
+    Counts a new request from `remote_addr` for rate limiting.
+
+    Returns a reservation to give to `cancel_request_reservation()` if the request fails, or `None`
+    if `remote_addr` already notified too many cases during the past period.
+    """
+
+    reservation = uuid.uuid4().hex
+
+    if redis_client is None:
+        # The request is counted by the `Request` row inserted with the keys.
+        period_start = g.now - RATE_LIMIT_PERIOD
+        count = models.Request.query                                            \
+            .filter_by(remote_addr=remote_addr)                                 \
+            .filter(models.Request.created_at >= period_start)                  \
+            .count()
+
+        return reservation if count < RATE_LIMIT_MAX_REQUESTS else None
+
+    now = time.time()
+    period = RATE_LIMIT_PERIOD.total_seconds()
+
+    is_reserved = _reserve_request_script(
+        keys=[_rate_limit_key(remote_addr)],
+        args=[now - period, RATE_LIMIT_MAX_REQUESTS, now, reservation, int(period)],
+    )
+
+    return reservation if is_reserved else None
+
+def cancel_request_reservation(remote_addr, reservation):
+    """Stops counting a request reserved with `reserve_request()` that failed."""
+
+    if redis_client is None:
+        return # The `Request` row has been rolled back with the keys.
+
+    try:
+        redis_client.zrem(_rate_limit_key(remote_addr), reservation)
+    except redis.RedisError:
+        app.logger.exception('Failed to cancel a rate limiting reservation.')
+
+# When rate limiting is handled by Redis, `Request` rows are only kept for auditing purposes and are
+# written after the response, on a best-effort basis.
+_audit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+def _insert_request(values):
+    # Inserted without the ORM's unit of work, as the row is never read back.
+    models.db.session.execute(models.Request.__table__.insert(), values)
+
+def _write_request_in_background(values):
+    """Inserts and commits a `Request` row, from an audit thread."""
+
+    with app.app_context():
+        try:
+            _insert_request(values)
+            models.db.session.commit()
+        except Exception:
+            app.logger.exception('Failed to write the request audit row.')
+
+# Serialized `/cases.json` responses of the current publication window, indexed by the window's
+# release time and then by the `since` parameter.
+_cases_cache = {}
+
+def _last_release_time(dt):
+    """Returns the last time at which new keys have been released, at `dt`."""
+
+    # Releases new keys only twice a day to avoid keys being grouped by the submitting user.
+    return dt.replace(hour=12 if dt.hour >= 12 else 0, minute=0, second=0, microsecond=0)
+
 @app.route('/cases.json')
 def cases():
-    """Returns the actives SARS-CoV-2 cases as a JSON document."""
+    """
+    Returns the actives SARS-CoV-2 cases as a JSON document.
 
-    now = datetime.datetime.utcnow()
-    today = now.date()
+    The optional `since` parameter (typically the `Last-Modified` header of a previous response, or
+    an ISO 8601 date or UTC date and time) only returns the keys released after that time. A
+    key is released at the first release time following both its creation and the end of its date.
+    Keys created shortly before `since` are returned again, and `since` values older than
+    `SINCE_MAX_AGE` return all the active keys.
+    """
 
-    # Does not return keys that are older than a typical infection period.
-    min_date = today - datetime.timedelta(days=INFECTION_PERIOD)
+    now = g.now
 
-    # Only return keys from the past days to avoid impersonation
-    max_date = today
+    min_creation_at = _last_release_time(now - RELEASE_DELAY)
+    today = min_creation_at.date()
 
-    # Releases new keys only twice a day to avoid keys being grouped by the submitting user.
-    if now.time().hour >= 12:
-        min_creation_at = datetime.datetime.combine(today, datetime.time(hour=12))
-    else:
-        min_creation_at = datetime.datetime.combine(today, datetime.time(hour=0))
-
-    keys = models.DailyKey.query                                                \
-        .filter(models.DailyKey.date > min_date)                                \
-        .filter(models.DailyKey.date < max_date)                                \
-        .filter(models.DailyKey.created_at <= min_creation_at)                  \
-        .order_by(models.DailyKey.key)                                          \
-        .all()
-
-    return {
-        'cases': [
-            {
-                'key': key.key,
-                'date': key.date.isoformat(),
-                'type': 'positive' if key.is_tested else 'symptomatic',
-            }
-            for key in keys
-        ]
-    }
+    since = request.args.get('since')
+    if since is not None:
+        since_str = since
+
+        # Accepts the HTTP date format of the `Last-Modified` header, or ISO 8601.
+        since = parse_date(since_str)
+        if since is None:
+            try:
+                since = datetime.datetime.fromisoformat(since_str)
+            except ValueError:
+                return 'Bad request', 400
+
+        if since.tzinfo is not None:
+            since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        # Keys are only released at fixed times. Rounding and clamping the value keeps the number of
+        # cached responses small.
+        since = _last_release_time(since)
+
+        if since < min_creation_at - SINCE_MAX_AGE:
+            since = None
+        else:
+            since = min(since, min_creation_at)
+
+    # The response only changes when new keys are released, it can be cached until then.
+    next_release_at = min_creation_at + datetime.timedelta(hours=12) + RELEASE_DELAY
+
+    window_cache = _cases_cache.get(min_creation_at)
+    if window_cache is None:
+        _cases_cache.clear()
+        window_cache = _cases_cache.setdefault(min_creation_at, {})
+
+    body = window_cache.get(since)
+
+    if body is None:
+        # Does not return keys that are older than a typical infection period.
+        min_date = today - datetime.timedelta(days=INFECTION_PERIOD)
+
+        # Only return keys from the past days to avoid impersonation
+        max_date = today
+
+        # Only fetches the required columns as plain tuples, without building ORM objects.
+        columns = (models.DailyKey.key, models.DailyKey.date, models.DailyKey.is_tested)
+        keys = models.db.session.query(*columns)                                \
+            .filter(models.DailyKey.date > min_date)                            \
+            .filter(models.DailyKey.date < max_date)                            \
+            .filter(models.DailyKey.created_at <= min_creation_at)
+
+        if since is not None:
+            # Keys created before `since` are still new if their date prevented their release.
+            #
+            # Also returns again the keys created just before `since`, in case they were committed
+            # after the previous response had been built (e.g. on a host with a late clock).
+            # Clients ignore the keys they already have.
+            keys = keys.filter(models.db.or_(
+                models.DailyKey.created_at > since - RELEASE_DELAY,
+                models.DailyKey.date >= since.date(),
+            ))
+
+        keys = keys.order_by(models.DailyKey.key).yield_per(1000)
+
+        # Serializes the keys as they are fetched from the database, so that they do not all have
+        # to be loaded in memory.
+        buf = io.BytesIO()
+        buf.write(b'{"cases":[')
+        for i, (key, date, is_tested) in enumerate(keys):
+            if i > 0:
+                buf.write(b',')
+
+            buf.write(orjson.dumps({
+                'key': key.hex(),
+                'date': date,
+                'type': 'positive' if is_tested else 'symptomatic',
+            }))
+        buf.write(b']}')
+
+        body = buf.getvalue()
+
+        window_cache[since] = body
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag('{}/{}'.format(
+        min_creation_at.isoformat(), since.isoformat() if since is not None else ''
+    ))
+    response.last_modified = min_creation_at
+    response.cache_control.public = True
+    response.cache_control.max_age = int((next_release_at - now).total_seconds())
+
+    # Returns a `304 Not Modified` response if the client already has this version.
+    return response.make_conditional(request)
 
 class DailyKeyForm(wtforms.Form):
     date = wtforms.DateField('Daily key date', [wtforms.validators.InputRequired()])
     value = wtforms.StringField('Daily key value (hexadecimal string)', [
         wtforms.validators.InputRequired(),
-        wtforms.validators.Length(min=DAILY_KEY_SIZE * 2, max=DAILY_KEY_SIZE * 2)
+        wtforms.validators.Regexp(
+            DAILY_KEY_REGEX,
+            message='Should be a {} characters hexadecimal string.'.format(DAILY_KEY_SIZE * 2)
+        ),
     ])
 
 class NotifyForm(wtforms.Form):
@@ -90,30 +280,37 @@ class NotifyForm(wtforms.Form):
     keys = wtforms.FieldList(wtforms.FormField(DailyKeyForm))
 
     def validate_keys(form, field):
-        if not field.data:
+        # Individual keys should be valid first.
+        if not field.data or field.errors:
             return
 
         expected_keys_count = INCUBATION_PERIOD + SYMPTOMS_TO_VIRUS_NEGATIVE
 
-        key_values = set(key['value'] for key in field.data)
-
         # All keys should be unique, and should match the expected count
+        key_values = set()
+        for key in field.data:
+            value = key['value'].lower()
+
+            if value in key_values:
+                raise wtforms.ValidationError('Daily keys should be unique.')
+
+            key_values.add(value)
+
         if len(key_values) != expected_keys_count:
             raise wtforms.ValidationError(
                 'Should contain {} daily keys.'.format(expected_keys_count)
             )
 
-        key_dates = sorted(key['date'] for key in field.data)
-
-        # There should not be any missing date
-        prev_date = None
-        for date in key_dates:
-            if prev_date is not None and date != prev_date + datetime.timedelta(days=1):
-                raise wtforms.ValidationError('Key dates should not contain gaps.')
+        key_dates = set(key['date'] for key in field.data)
+        min_date = min(key_dates)
 
-            prev_date = date
+        # There should not be any missing date. As there are as many distinct dates as keys, that
+        # is the case iff they span exactly that many days.
+        if len(key_dates) != expected_keys_count                                \
+                or (max(key_dates) - min_date).days != expected_keys_count - 1:
+            raise wtforms.ValidationError('Key dates should not contain gaps.')
 
-        if key_dates[0] > datetime.datetime.utcnow().date():
+        if min_date > g.today:
             raise wtforms.ValidationError('Key dates can not all be in the future.')
 
 @app.route('/notify', methods=['POST'])
@@ -131,11 +328,13 @@ def notify():
 
     if form.validate():
         # Does not allow to override an already reported case.
-        already_exists = models.DailyKey.query                                          \
-            .filter(models.DailyKey.key.in_(key['value'] for key in form.keys.data))    \
-            .count()
+        key_values = [bytes.fromhex(key['value']) for key in form.keys.data]
 
-        if already_exists > 0:
+        already_exists = models.db.session.query(
+            models.DailyKey.query.filter(models.DailyKey.key.in_(key_values)).exists()
+        ).scalar()
+
+        if already_exists:
             return 'Forbidden', 403
 
         # Does not allow more than 5 requests per IP per hour.
@@ -147,37 +346,54 @@ def notify():
         if not request.headers.getlist("X-Forwarded-For"):
             remote_addr = request.remote_addr
         else:
-            remote_addr = request.headers.getlist("X-Forwarded-For")[0]
+            # The header might contain the addresses of the proxies after the client's.
+            remote_addr = request.headers.getlist("X-Forwarded-For")[0].split(',')[0].strip()
+
+        try:
+            remote_addr = ipaddress.ip_address(remote_addr).compressed
+        except ValueError:
+            return 'Bad request', 400
 
         user_agent = request.headers.get('User-Agent')
 
-        one_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
-        prev_reporting_count = models.Request.query                         \
-            .filter_by(remote_addr=remote_addr)                             \
-            .filter(models.Request.created_at >= one_hour_ago)              \
-            .count()
+        reservation = reserve_request(remote_addr)
 
-        if prev_reporting_count >= 5:
+        if reservation is None:
             return 'Too many requests', 429
 
         # --
 
-        for key in form.keys.data:
-            db_key = models.DailyKey(
-                key=key['value'],
-                date=key['date'],
-                is_tested=form.is_tested.data,
-            )
-            models.db.session.add(db_key)
-
-        req = models.Request(
-            remote_addr=remote_addr,
-            user_agent=user_agent,
-            comment=form.comment.data,
-        )
-        models.db.session.add(req)
-
-        models.db.session.commit()
+        now = g.now
+
+        request_values = {
+            'remote_addr': remote_addr,
+            'user_agent': user_agent,
+            'comment': form.comment.data,
+            'created_at': now,
+        }
+
+        try:
+            models.bulk_copy_daily_keys(models.db.session, [
+                {
+                    'key': key_value,
+                    'date': key['date'],
+                    'created_at': now,
+                    'is_tested': form.is_tested.data,
+                }
+                for key, key_value in zip(form.keys.data, key_values)
+            ])
+
+            if redis_client is None:
+                # Rate limiting relies on the `requests` table, it must be written with the keys.
+                _insert_request(request_values)
+
+            models.db.session.commit()
+        except Exception:
+            cancel_request_reservation(remote_addr, reservation)
+            raise
+
+        if redis_client is not None:
+            _audit_executor.submit(_write_request_in_background, request_values)
 
         return 'Created', 201
     else:
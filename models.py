@@ -15,8 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with CovidTracer. If not, see<https://www.gnu.org/licenses/>.
 
-import datetime
+import datetime, io
 
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.schema import Index
 
 from app import db, DAILY_KEY_SIZE
@@ -24,10 +25,10 @@ from app import db, DAILY_KEY_SIZE
 class DailyKey(db.Model):
     __tablename__ = 'daily_keys'
 
-    date = db.Column(db.Date(), nullable=False, primary_key=True)
+    # The primary key starts with `key` so that it can be used to look up already reported keys.
+    key = db.Column(db.LargeBinary(length=DAILY_KEY_SIZE), primary_key=True)
 
-    # Stores the key as an hexadecimal string.
-    key = db.Column(db.String(length=DAILY_KEY_SIZE * 2), primary_key=True, index=True)
+    date = db.Column(db.Date(), nullable=False, primary_key=True)
 
     created_at = db.Column(
         db.DateTime(), nullable=False, index=True, default=datetime.datetime.utcnow
@@ -35,6 +36,40 @@ class DailyKey(db.Model):
 
     is_tested = db.Column(db.Boolean(), nullable=False) # Has it been tested against Covid-19?
 
+def bulk_copy_daily_keys(session, rows):
+    """
+    Inserts the `rows` daily keys (dictionaries of `DailyKey` column values) in a single statement.
+
+    Uses PostgreSQL's `COPY ... FROM STDIN` when available, and falls back to a multi-row `INSERT`
+    on other database engines.
+    """
+
+    if not rows:
+        return
+
+    if session.get_bind().dialect.name != 'postgresql':
+        session.execute(DailyKey.__table__.insert(), rows)
+        return
+
+    columns = ('date', 'key', 'created_at', 'is_tested')
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('{}\t{}\t{}\t{}\n'.format(
+            row['date'].isoformat(),
+            '\\\\x' + row['key'].hex(), # Hexadecimal `bytea` literal, with an escaped backslash.
+            row['created_at'].isoformat(),
+            't' if row['is_tested'] else 'f',
+        ))
+    buf.seek(0)
+
+    # Runs within the session's current transaction.
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_from(buf, DailyKey.__tablename__, columns=columns, sep='\t')
+    finally:
+        cursor.close()
+
 class Request(db.Model):
     """Stores information, mostly for rate limiting purposes."""
 
@@ -49,9 +84,13 @@ class Request(db.Model):
     created_at = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow)
 
     # Information about the notifying device.
-    remote_addr = db.Column(db.String, nullable=False)
+    remote_addr = db.Column(
+        db.String().with_variant(postgresql.INET(), 'postgresql'), nullable=False
+    )
     user_agent = db.Column(db.String, nullable=True)
 
     comment = db.Column(db.String(1000))
 
+# Covers the rate limiting query (`app.reserve_request()`), which filters on both columns and can
+# be answered with an index-only scan.
 Index('idx_requests', Request.remote_addr, Request.created_at)